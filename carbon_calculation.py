@@ -3,29 +3,30 @@ import csv
 import sys
 import datetime
 import random
-from typing import List, Optional, Tuple
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 
+_SEC_PER_HR = 3600.0
+
 
 def _collect_caiso_data_1(fname):
     # kgCO2 per MWh
-    with open(fname) as f:
-        reader = csv.DictReader(f)
-        return [{
-                "Datetime": datetime.datetime.strptime(line["Datetime"], "%m/%d/%Y %H:%M"),
-                "AvgCarbonIntensity": float(line["AvgCarbonIntensity"])
-                } for line in reader]
+    df = pd.read_csv(fname, usecols=["Datetime", "AvgCarbonIntensity"],
+                     dtype={"AvgCarbonIntensity": np.float32})
+    # Explicit format, no inference; raises ValueError on a malformed timestamp
+    df["Datetime"] = pd.to_datetime(df["Datetime"], format="%m/%d/%Y %H:%M", cache=True)
+    return df
 
 
 def _collect_caiso_data_2(fname):
     # kgCO2 per MWh
-    with open(fname) as f:
-        reader = csv.DictReader(f)
-        return [{
-                "Datetime": datetime.datetime.strptime(line["Datetime"], "%Y-%m-%d %H:%M:%S"),
-                "AvgCarbonIntensity": float(line["AvgCarbonIntensity"])
-                } for line in reader]
+    df = pd.read_csv(fname, usecols=["Datetime", "AvgCarbonIntensity"],
+                     dtype={"AvgCarbonIntensity": np.float32})
+    df["Datetime"] = pd.to_datetime(df["Datetime"], format="%Y-%m-%d %H:%M:%S", cache=True)
+    return df
 
 
 def _read_jobs(fname):
@@ -35,21 +36,18 @@ def _read_jobs(fname):
             {**line, **{
                 "server_utilization": float(line["server_utilization"]),
                 "time": datetime.timedelta(hours=float(line["time"])),
+                "carbon_budget": float(line["carbon_budget"]),
             }} for line in reader
         ]
 
 
-class HourlyAllocation:
-    def __init__(self, energy=0.0):
-        self.energy = energy
-        self.jobs = []
-
-    def __repr__(self) -> str:
-        # return f"{self.energy}: {self.jobs}"
-        return f"{self.energy} ({len(self.jobs)})"
-
-    def __str__(self) -> str:
-        return self.energy
+class HwSpec(NamedTuple):
+    cores: int
+    embodied_carbon: float  # kgCO2
+    tdp: float  # Watts
+    tdp_coefficient: float
+    lifetime: datetime.timedelta
+    mflo_per_sec: Optional[float] = None
 
 
 class CloudScheduler:
@@ -57,34 +55,46 @@ class CloudScheduler:
 
     # Hardware specs
     hardware_specs = {
-        "xeon_e5_2670": {
-            "cores": 10,
-            "embodied_carbon": 2216.20,
-            "tdp": 115,
-            "tdp_coefficient": 0.25,
-            "lifetime": AVG_HARDWARE_USAGE_PER_YR_HRS * 4.2,
-        },
-        "amd_epyc_7571": {
-            "cores": 32,
-            "embodied_carbon": 1610.40,
-            "tdp": 120,  # Watts
-            "tdp_coefficient": 0.3,
-            "lifetime": AVG_HARDWARE_USAGE_PER_YR_HRS * 4.5,
-        },
-        "xeon_platinum_8176": {
-            "cores": 28,
-            "embodied_carbon": 35762.3,
-            "tdp": 165,
-            "tdp_coefficient": 0.3,
-            "lifetime": AVG_HARDWARE_USAGE_PER_YR_HRS * 3.8,
-        }
+        "xeon_e5_2670": HwSpec(
+            cores=10,
+            embodied_carbon=2216.20,
+            tdp=115,
+            tdp_coefficient=0.25,
+            lifetime=AVG_HARDWARE_USAGE_PER_YR_HRS * 4.2,
+        ),
+        "amd_epyc_7571": HwSpec(
+            cores=32,
+            embodied_carbon=1610.40,
+            tdp=120,  # Watts
+            tdp_coefficient=0.3,
+            lifetime=AVG_HARDWARE_USAGE_PER_YR_HRS * 4.5,
+        ),
+        "xeon_platinum_8176": HwSpec(
+            cores=28,
+            embodied_carbon=35762.3,
+            tdp=165,
+            tdp_coefficient=0.3,
+            lifetime=AVG_HARDWARE_USAGE_PER_YR_HRS * 3.8,
+        ),
     }
 
+    # Per-hardware constants: MWh per hour at full utilization, and
+    # embodied carbon per second of runtime
+    _k = {name: spec.cores * spec.tdp * spec.tdp_coefficient / 1e6
+          for (name, spec) in hardware_specs.items()}
+    _emb_rate = {name: spec.embodied_carbon / spec.lifetime.total_seconds()
+                 for (name, spec) in hardware_specs.items()}
+
     def __init__(self, intensity_data_fname: str, slot_algo: str):
         self.intensity_data = _collect_caiso_data_1(intensity_data_fname)
+        # Intensity and scheduled energy (MWh) for each hour of the day
+        self.intensity = self.intensity_data["AvgCarbonIntensity"].to_numpy(dtype=np.float32)[:24]
+        self.energy = np.zeros(24, dtype=np.float64)
+        # Undampened slot order never changes, so sort it once
+        self._static_order = np.argsort(self.intensity, kind="stable")
         self.slot_algo = slot_algo
-        # Pair of (Amount of energy scheduled, list of jobs and time to run) for each hour of the day
-        self.current_allocation = [HourlyAllocation() for i in range(24)]
+        # List of jobs and time to run for each hour of the day
+        self.jobs_per_hour = [[] for i in range(24)]
         self.allocation_by_job = {}
         self.job_carbon = []
 
@@ -94,111 +104,145 @@ class CloudScheduler:
 
         # How long will this job take? (in seconds)
         time_taken = datetime.timedelta(
-            seconds=job["mflo"] / hw["mflo_per_sec"])
+            seconds=job["mflo"] / hw.mflo_per_sec)
         return time_taken
 
     @staticmethod
     def embodied_carbon(job):
-        hw = CloudScheduler.hardware_specs[job["hardware"]]
-
-        # flops / total lifetime flops * total embodied carbon = job embodied carbon
-        embodied = (
-            job["time"] / hw["lifetime"]) * hw["embodied_carbon"]
-
-        return embodied
+        # runtime / total lifetime * total embodied carbon = job embodied carbon
+        return job["time"].total_seconds() * CloudScheduler._emb_rate[job["hardware"]]
 
     @staticmethod
     def energy_per_hr(job):
-        time_required_hrs = job["time"] / datetime.timedelta(hours=1)
-        energy_consumed = CloudScheduler.energy_consumed(job)
-        return energy_consumed / time_required_hrs
+        # Returns MWh per hour of runtime
+        return job["server_utilization"] * CloudScheduler._k[job["hardware"]]
 
+    @staticmethod
     def energy_consumed(job):
         # Returns MWh
-        hw = CloudScheduler.hardware_specs[job["hardware"]]
-
-        en = job["server_utilization"] * (job["time"] / datetime.timedelta(hours=1)) * \
-            hw["cores"] * hw["tdp"] * hw["tdp_coefficient"] / 1e6
-        return en
+        return CloudScheduler.energy_per_hr(job) * \
+            job["time"].total_seconds() / _SEC_PER_HR
 
     def submit_job(self, job) -> Optional[float]:
-        # Start with embodied carbon
+        # Compute everything derived from the job once
+        time_required_hrs = job["time"].total_seconds() / _SEC_PER_HR
+        energy_per_hr = CloudScheduler.energy_per_hr(job)
         embCarbon = CloudScheduler.embodied_carbon(job)
 
-        # Optimize for operational carbon
-        operCarbon = 0.0
+        slots = self.get_best_slots(
+            time_required_hrs, energy_per_hr, embCarbon, job["carbon_budget"])
+        return self._record_job(job, slots, energy_per_hr, embCarbon)
+
+    def submit_jobs(self, jobs) -> List[Optional[float]]:
+        if self.slot_algo != "simple":
+            # Each placement changes the dampened scores the next job sees, so
+            # each job is placed and recorded before the next one is looked at
+            results = []
+            for job in jobs:
+                results.append(self.submit_job(job))
+            return results
+
+        # Slot order is fixed and jobs don't affect each other's scores, so fit
+        # the whole batch in one pass
+        time_required_hrs = np.array(
+            [j["time"].total_seconds() for j in jobs]) / _SEC_PER_HR
+        energy_per_hr = np.array([CloudScheduler.energy_per_hr(j) for j in jobs])
+        embodied = np.array([CloudScheduler.embodied_carbon(j) for j in jobs])
+        budget = np.array([j["carbon_budget"] for j in jobs], dtype=np.float64)
+
+        slots_per_job = self._fit_slots(
+            self._slot_scores(False), self._static_order,
+            time_required_hrs, energy_per_hr, budget - embodied)
+
+        return [self._record_job(job, slots, e, emb) for (job, slots, e, emb) in zip(
+            jobs, slots_per_job, energy_per_hr.tolist(), embodied.tolist())]
+
+    def _record_job(self, job, slots, energy_per_hr, embCarbon) -> Optional[float]:
+        # A job with no runtime gets no slots, which would look like a failure
+        if job["time"] <= datetime.timedelta(0):
+            raise ValueError(f'job {job["id"]} has non-positive time {job["time"]}')
 
-        slots = self.get_best_slots(job)
         if len(slots) == 0:
             return None
 
-        energy_per_hr = CloudScheduler.energy_per_hr(job)
+        # Operational carbon over the chosen slots
+        operCarbon = 0.0
 
         allocation = [0] * 24
 
         for (idx, intensity, time_usage) in slots:
-            self.current_allocation[idx].energy += energy_per_hr * time_usage
-            self.current_allocation[idx].jobs.append(
+            self.energy[idx] += energy_per_hr * time_usage
+            self.jobs_per_hour[idx].append(
                 {"id": job["id"], "time": time_usage})
             allocation[idx] += time_usage
             operCarbon += intensity * energy_per_hr * time_usage
 
+        carbon = float(embCarbon + operCarbon)
         self.allocation_by_job[job["id"]] = allocation
-        self.job_carbon.append(embCarbon + operCarbon)
+        self.job_carbon.append(carbon)
 
-        return embCarbon + operCarbon
+        return carbon
 
-    def get_best_slots(self, job) -> List[Tuple[int, float, float]]:
+    def get_best_slots(self, time_required_hrs, energy_per_hr, embodied, budget) -> List[Tuple[int, float, float]]:
         if self.slot_algo == "simple":
-            return self.get_best_slots_v1(job, False)
+            return self.get_best_slots_v1(time_required_hrs, energy_per_hr, embodied, budget, False)
         elif self.slot_algo == "min_alloc":
-            return self.get_best_slots_v1(job, True)
+            return self.get_best_slots_v1(time_required_hrs, energy_per_hr, embodied, budget, True)
         # else ... other algorithms here!
 
-    def get_best_slots_v1(self, job, dampen=False):
-        after = [(idx, self.get_adjusted_intensity(idx) if dampen else self.get_intensity(idx)) for idx in range(24)]
-        sorted_slots = sorted(after, key=lambda o: o[1])
-
-        energy_per_hr = CloudScheduler.energy_per_hr(job)
-
-        time_required_hrs = job["time"] / datetime.timedelta(hours=1)
-        projected_carbon = CloudScheduler.embodied_carbon(job)
-        success = True
+    def get_best_slots_v1(self, time_required_hrs, energy_per_hr, embodied, budget, dampen=False):
+        scores = self._slot_scores(dampen)
+        order = np.argsort(scores, kind="stable") if dampen else self._static_order
+
+        # Fill the cleanest slots in order, one hour per slot with the remainder
+        # last; slots past the end of the job get zero usage
+        time_usage = np.minimum(1.0, np.maximum(0.0, time_required_hrs - np.arange(len(order))))
+        intensity = scores[order]
+
+        # Slot carbon is never negative, so the job goes over budget in some
+        # slot exactly when its total does
+        if (energy_per_hr * time_usage * intensity).sum() > budget - embodied:
+            return []
+
+        # Zero usage only ever appears as a tail, so the used slots are a prefix
+        time_usage = time_usage.tolist()
+        num_slots = len(time_usage) - time_usage.count(0.0)
+        return list(zip(order[:num_slots].tolist(), intensity[:num_slots].tolist(),
+                        time_usage[:num_slots]))
+
+    def _fit_slots(self, scores, order, time_required_hrs, energy_per_hr, remaining_budget):
+        # Batch form of get_best_slots_v1 for a fixed slot order, one row per job
+        time_usage = np.minimum(1.0, np.maximum(
+            0.0, time_required_hrs[:, None] - np.arange(len(order))))
+        intensity = scores[order]
+
+        # Compute overall carbon per job. Slot carbon is never negative, so a
+        # job goes over budget in some slot exactly when its total does
+        total_carbon = (energy_per_hr[:, None] * time_usage * intensity).sum(axis=1)
+        fits = total_carbon <= remaining_budget
+
+        # Zero usage only ever appears as a tail, so the used slots are a prefix
+        order = order.tolist()
+        intensity = intensity.tolist()
         best_slots = []
-
-        # Allocate job, compute overall carbon, return success
-        for (idx, intensity) in sorted_slots:
-            time_usage = min(1, time_required_hrs)
-
-            # How much carbon would we get from this slot?
-            projected_carbon += energy_per_hr * time_usage * intensity
-            if projected_carbon > float(job["carbon_budget"]):
-                success = False
-                break
-
-            best_slots.append((idx, intensity, time_usage))
-
-            time_required_hrs -= 1
-            if time_required_hrs <= 0:
-                break
-
-        return best_slots if success else []
-
-    def get_intensity(self, idx):
-        return self.intensity_data[idx]["AvgCarbonIntensity"]
-
-    def get_adjusted_intensity(self, idx):
-        return self.intensity_data[idx]["AvgCarbonIntensity"] + \
-            200e6*self.current_allocation[idx].energy / \
-            self.intensity_data[idx]["AvgCarbonIntensity"]
+        for (ok, usage) in zip(fits.tolist(), time_usage.tolist()):
+            num_slots = len(usage) - usage.count(0.0)
+            best_slots.append(list(zip(order[:num_slots], intensity[:num_slots],
+                                       usage[:num_slots])) if ok else [])
+        return best_slots
+
+    def _slot_scores(self, dampen=False):
+        # Intensity of each hour, optionally raised by the energy already scheduled there
+        if not dampen:
+            return self.intensity
+        return self.intensity + 200e6*self.energy/self.intensity
 
     def show_allocation(self, show=False):
-        for i,x in enumerate(self.current_allocation):
-            if x.energy == 0:
-                continue
+        # Only hours with energy scheduled are worth reporting
+        for i in np.flatnonzero(self.energy).tolist():
             job_descr = ", ".join(
-                [f'job {j["id"]} for {j["time"]:.3f} hr(s)' for j in x.jobs])
-            print(f"{i}:00\t{x.energy*(10**6):.3f}Wh\t{job_descr}")
+                [f'job {j["id"]} for {j["time"]:.3f} hr(s)' for j in self.jobs_per_hour[i]])
+            print(f"{i}:00\t{self.energy[i]*(10**6):.3f}Wh\t{job_descr}")
 
         print("Job carbon:", self.job_carbon)
 
@@ -206,15 +250,14 @@ class CloudScheduler:
         color = 'tab:blue'
         ax1.set_xlabel("hour of day (24hr)")
         ax1.set_ylabel("number of jobs allocated", color=color)
-        ax1.bar(range(24), [len(ha.jobs)
-                for ha in self.current_allocation], color=color, label='job count')
+        ax1.bar(range(24), [len(jobs)
+                for jobs in self.jobs_per_hour], color=color, label='job count')
         ax1.tick_params(axis='y', labelcolor=color)
 
         ax2 = ax1.twinx()
         color = 'tab:green'
         ax2.set_ylabel("energy consumption (MWh)", color=color)
-        ax2.plot(range(24), [
-            ha.energy for ha in self.current_allocation], color=color, label='energy')
+        ax2.plot(range(24), self.energy, color=color, label='energy')
         ax2.tick_params(axis='y', labelcolor=color)
 
         fig.tight_layout()
@@ -239,8 +282,7 @@ def main(alloc):
 
     jobs = _read_jobs("sample_jobs.csv")
 
-    for j in jobs:
-        res = scheduler.submit_job(j)
+    for (j, res) in zip(jobs, scheduler.submit_jobs(jobs)):
         if res == None:
             print("Failed to allocate job", j["id"])
         else: